@@ -3,14 +3,104 @@ mail-alias: Manage e-mail aliases using the Plesk XML RPC API
 """
 
 import os
+import sys
+import io
+import re
+import json
+import tempfile
+import functools
+import atexit
 import argparse
 import http.client
+import xml.sax.saxutils
 import ssl
-import lxml
-import lxml.etree
 
 PROGRAM_DESCRIPTION = "Manager e-mail aliases via plesk"
 
+# The responses to alias updates are tiny and only the status of each result
+# is of interest, so it is matched directly instead of being parsed into a tree
+_RESULT_STATUS_RE = re.compile(rb"<result>\s*<status>([^<]+)</status>")
+
+# Error 1013 ("object does not exist") as reported for a single operation. It is
+# the error for a site id that does not exist (anymore), but also for e.g. an
+# unknown mail account. The error text is not relied upon to tell these apart;
+# instead the site is looked up again (see _refresh_cached_site_id()).
+_OBJECT_NOT_FOUND_RE = re.compile(rb"<result>\s*<status>error</status>\s*"
+                                  rb"<errcode>1013</errcode>")
+
+# Options of the parser for the XML RPC responses. Features that are not needed
+# for the small Plesk responses are disabled; this also prevents entity
+# expansion attacks.
+_PARSER_OPTIONS = {
+    "collect_ids": False,
+    "resolve_entities": False,
+    "remove_blank_text": True,
+    "huge_tree": False,
+    "no_network": True,
+}
+
+# Templates for the XML RPC requests
+_SITE_GET_TEMPLATE = (b"<packet><site><get><filter><name>%s</name></filter>"
+                      b"<dataset><gen_info/></dataset></get></site></packet>")
+_MAIL_PACKET_TEMPLATE = b"<packet><mail>%s</mail></packet>"
+_ADD_TEMPLATE = (b"<update><add><filter><site-id>%d</site-id><mailname><name>%s</name>"
+                 b"<alias>%s</alias></mailname></filter></add></update>")
+_REMOVE_TEMPLATE = (b"<update><remove><filter><site-id>%d</site-id><mailname><name>%s</name>"
+                    b"<alias>%s</alias></mailname></filter></remove></update>")
+_GET_INFO_TEMPLATE = (b"<packet><mail><get_info><filter><site-id>%d</site-id><name>%s</name>"
+                      b"</filter><aliases/></get_info></mail></packet>")
+
+
+def _lazy_etree():
+    """Return lxml.etree, which is expensive to import and only needed by some operations"""
+    import lxml.etree
+    return lxml.etree
+
+
+@functools.lru_cache(maxsize=None)
+def _xml_parser():
+    """Return the parser for the XML RPC responses, created on first use"""
+    return _lazy_etree().XMLParser(**_PARSER_OPTIONS)
+
+
+@functools.lru_cache(maxsize=None)
+def _xpaths():
+    """Return the precompiled XPath expressions for evaluating responses, compiled on first use"""
+    etree = _lazy_etree()
+    return {
+        "status": etree.XPath("status/text()"),
+        "site_results": etree.XPath("/packet/site/get/result"),
+        "site_name": etree.XPath("data/gen_info/name/text()"),
+        "site_id": etree.XPath("id/text()"),
+    }
+
+
+def _xml_escape(text):
+    """Escape `text` for use as XML character data and encode it"""
+    return xml.sax.saxutils.escape(text).encode("utf-8")
+
+
+class _ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection that resumes the given TLS session (if any) on connect
+    """
+
+    def __init__(self, host, port, context, session=None):
+        super().__init__(host, port, context=context)
+        self._tls_session = session
+
+    def connect(self):
+        # Same as HTTPSConnection.connect() but passes the session to wrap_socket()
+        http.client.HTTPConnection.connect(self)
+
+        if self._tunnel_host:
+            server_hostname = self._tunnel_host
+        else:
+            server_hostname = self.host
+
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname,
+                                              session=self._tls_session)
+
 
 class PleskApiClient:
     """
@@ -24,6 +114,9 @@ class PleskApiClient:
         self.ssl_unverified = ssl_unverified
         self.login = None
         self.passwd = None
+        self._conn = None
+        self._ssl_context = None
+        self._tls_session = None
 
     def set_credentials(self, login, passwd):
         """Set the API user name and the password to use"""
@@ -35,9 +128,14 @@ class PleskApiClient:
         self.secret_key = secret_key
 
     def request(self, request):
-        """Issue the specified XML RPC request. `request` must be a valid XML string"""
+        """Issue the specified XML RPC request. `request` must be a valid XML document"""
+        # http.client would encode a str body as Latin-1, so encode it here and
+        # send it with an explicit length
+        body = request.encode("utf-8") if isinstance(request, str) else request
+
         headers = {}
         headers["Content-type"] = "text/xml"
+        headers["Content-Length"] = str(len(body))
         headers["HTTP_PRETTY_PRINT"] = "TRUE"
 
         if self.secret_key:
@@ -46,157 +144,268 @@ class PleskApiClient:
             headers["HTTP_AUTH_LOGIN"] = self.login
             headers["HTTP_AUTH_PASSWD"] = self.passwd
 
-        if self.ssl_unverified is True:
-            conn = http.client.HTTPSConnection(self.host, self.port,
-                                            context=ssl._create_unverified_context())
-            raise Exception("Certificate exception verification can only be "
-                            "skipped by removing this exception")
-        else:
-            conn = http.client.HTTPSConnection(self.host, self.port)
+        headers["Connection"] = "keep-alive"
+
+        reused = self._conn is not None
+        try:
+            return self._post(body, headers)
+        except (ConnectionError, ssl.SSLEOFError):
+            # The server may have closed the idle connection in the meantime. Over
+            # TLS this typically shows as SSLEOFError on send. RemoteDisconnected
+            # is a ConnectionError. A failure on a fresh connection is not retried
+            # since the request may already have been applied.
+            if not reused:
+                raise
+            return self._post(body, headers)
+
+    def close(self):
+        """Close the connection to the API endpoint (if any)"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self):
+        # The context is shared between connections so that TLS sessions can be resumed
+        if self._ssl_context is None:
+            if self.ssl_unverified is True:
+                context = ssl._create_unverified_context()
+                raise Exception("Certificate exception verification can only be "
+                                "skipped by removing this exception")
+            else:
+                context = ssl.create_default_context()
+
+            # HTTPSConnection only applies these settings to the default context
+            context.set_alpn_protocols(["http/1.1"])
+            if context.post_handshake_auth is not None:
+                context.post_handshake_auth = True
+
+            self._ssl_context = context
+
+        return _ResumingHTTPSConnection(self.host, self.port, self._ssl_context,
+                                        self._tls_session)
+
+    def _post(self, body, headers):
+        if self._conn is None:
+            self._conn = self._connect()
 
-        conn.request("POST", "/enterprise/control/agent.php", request, headers)
-        response = conn.getresponse()
+        try:
+            self._conn.request("POST", "/enterprise/control/agent.php", body, headers)
+            response = self._conn.getresponse()
+
+            # The response must be consumed completely before the connection can be reused
+            data = response.read()
+        except Exception:
+            # The connection is in an undefined state and cannot be reused
+            self.close()
+            raise
 
-        return response.read()
+        if self._conn.sock is not None:
+            self._tls_session = self._conn.sock.session
+
+        return data
+
+class SiteIdCache:
+    """
+    Persistent cache for the mapping of site names to site ids
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_dir = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            path = os.path.join(cache_dir, "plesk-mail-aliases", "site-ids.json")
+        self.path = path
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._ids = json.load(f)
+        except (OSError, ValueError):
+            self._ids = {}
+
+        # Ignore a cache file that was not written by us
+        if not isinstance(self._ids, dict) or \
+           not all(isinstance(k, str) and type(v) is int for k, v in self._ids.items()):
+            self._ids = {}
+
+    @classmethod
+    def _key(cls, host, site):
+        return f"{host}/{site}"
+
+    def get(self, host, site):
+        """Return the cached id of the site or None"""
+        return self._ids.get(self._key(host, site))
+
+    def set(self, host, site, site_id):
+        """Remember the id of the site"""
+        self._ids[self._key(host, site)] = site_id
+        self._store()
+
+    def invalidate(self, host, site):
+        """Forget the id of the site"""
+        if self._ids.pop(self._key(host, site), None) is not None:
+            self._store()
+
+    def _store(self):
+        # The cache is an optimization only, failing to write it is not an error
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False,
+                                             dir=os.path.dirname(self.path)) as f:
+                tmp = f.name
+                json.dump(self._ids, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            if tmp is not None:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
 
 class PleskMailAliasManager:
     """
     Manager for mail aliases
     """
 
-    def __init__(self, client, site):
+    def __init__(self, client, site, cache=None):
         self._client = client
         self._site = site
-        self._site_id = self._get_site_id()
+        self._site_id = None
+        self._site_id_from_cache = False
+        self._cache = cache
+
+    @property
+    def site_id(self):
+        """Id of the site, taken from the cache or looked up on first use"""
+        if self._site_id is None and self._cache is not None:
+            self._site_id = self._cache.get(self._client.host, self._site)
+            self._site_id_from_cache = self._site_id is not None
+
+        if self._site_id is None:
+            self._site_id = self._get_site_id()
+            if self._cache is not None:
+                self._cache.set(self._client.host, self._site, self._site_id)
+
+        return self._site_id
+
+    def _refresh_cached_site_id(self, resp, count=1):
+        """
+        Check whether a failed request was caused by a stale site id from the
+        cache. If all `count` operations in the response failed with error 1013,
+        the site is looked up again. Returns True if the id changed and the
+        failed request should be retried with the new id.
+        """
+        if not self._site_id_from_cache or \
+           count != len(_OBJECT_NOT_FOUND_RE.findall(resp)):
+            return False
+
+        # Drop the entry first so that it does not survive if the site is gone
+        self._cache.invalidate(self._client.host, self._site)
+        cached_site_id, self._site_id = self._site_id, None
+        self._site_id_from_cache = False
+
+        return cached_site_id != self.site_id
 
     @classmethod
-    def _xml_packet(cls, xml):
-        return f"<packet>{xml}</packet>"
+    def _verify_status_ok(cls, resp, count=1):
+        status = _RESULT_STATUS_RE.findall(resp)
+        return count == len(status) and all(b"ok" == s for s in status)
 
     @classmethod
-    def _xml_find_one(cls, el, path):
-        el = el.findall(path)
+    def _xml_find_one(cls, el, xpath):
+        el = xpath(el)
         if 1 != len(el):
-            raise Exception("_xml_find_one() assumes that findall() returns exactly one result")
+            raise Exception("_xml_find_one() assumes that the XPath returns exactly one result")
         return el[0]
 
-    @classmethod
-    def _verify_status_ok(cls, path, response):
-        try:
-            result = cls._xml_find_one(response, f"{path}/status")
-        except Exception:
-            return False
-
-        return "ok" == result.text
-
     def _get_site_id(self):
-        request = self._xml_packet(f"""\
-<site>
-    <get>
-    <filter>
-        <name>{self._site}</name>
-    </filter>
-    <dataset>
-        <gen_info/>
-    </dataset>
-    </get>
-</site>\
-""")
+        request = _SITE_GET_TEMPLATE % _xml_escape(self._site)
 
         resp = self._client.request(request)
-        response = lxml.etree.XML(resp)
 
+        # The gen_info dataset carries elements (e.g., the status of the site)
+        # with the same names as the result, so evaluate the response as a tree
+        response = _lazy_etree().fromstring(resp, _xml_parser())
+
+        xpaths = _xpaths()
         site_id = None
 
-        for result in response.findall("./site/get/result"):
-            if not self._verify_status_ok(".", result):
+        for result in xpaths["site_results"](response):
+            if ["ok"] != xpaths["status"](result):
                 raise Exception(f"XML RPC response was not okay: '{resp}'")
 
-            if self._site != self._xml_find_one(result, "./data/gen_info/name").text:
+            if self._site != self._xml_find_one(result, xpaths["site_name"]):
                 raise Exception("XML RPC response does not match specified site name")
 
-            site_id = int(self._xml_find_one(result, "./id").text)
+            site_id = int(self._xml_find_one(result, xpaths["site_id"]))
 
         if site_id is None:
             raise Exception(f"XML RPC response was not okay: '{resp}'")
 
-        return int(site_id)
-
-    @classmethod
-    def _xml_mail_packet(cls, xml):
-        return cls._xml_packet(f"<mail>{xml}</mail>")
-
-    def _xml_mail_filter_site_account_alias(self, account, alias):
-        return f"""\
-<filter>
-    <site-id>{self._site_id}</site-id>
-    <mailname>
-        <name>{account}</name>
-        <alias>{alias}</alias>
-    </mailname>
-</filter>\
-"""
+        return site_id
 
     def add_mail_alias(self, account, alias):
         """
         Add the specified mail alias for the account.
         """
-        request = self._xml_mail_packet(f"""\
-<update>
-    <add>
-        {self._xml_mail_filter_site_account_alias(account, alias)}
-    </add>
-</update>\
-""")
-
-        resp = self._client.request(request)
-        response = lxml.etree.XML(resp)
-
-        if not self._verify_status_ok("./mail/update/add/result", response):
-            raise Exception(f"XML RPC response was not okay: '{resp}'")
+        self.apply_changes([(account, alias)], [])
 
     def del_mail_alias(self, account, alias):
         """
         Delete the specified mail alias for the account.
         """
-        request = self._xml_mail_packet(f"""\
-<update>
-    <remove>
-        {self._xml_mail_filter_site_account_alias(account, alias)}
-    </remove>
-</update>\
-""")
+        self.apply_changes([], [(account, alias)])
+
+    def apply_changes(self, adds, removes):
+        """
+        Add and remove mail aliases with a single XML RPC request. `adds` and
+        `removes` are lists of (account, alias) tuples.
+        """
+        if not adds and not removes:
+            return
+
+        ops = []
+        for template, changes in ((_ADD_TEMPLATE, adds), (_REMOVE_TEMPLATE, removes)):
+            for account, alias in changes:
+                ops.append(template % (self.site_id, _xml_escape(account), _xml_escape(alias)))
+
+        request = _MAIL_PACKET_TEMPLATE % b"".join(ops)
 
         resp = self._client.request(request)
-        response = lxml.etree.XML(resp)
 
-        if not self._verify_status_ok("./mail/update/remove/result", response):
+        # Every operation in the packet reports its own status
+        if not self._verify_status_ok(resp, len(adds) + len(removes)):
+            if self._refresh_cached_site_id(resp, len(adds) + len(removes)):
+                return self.apply_changes(adds, removes)
             raise Exception(f"XML RPC response was not okay: '{resp}'")
 
     def query_aliases(self, account):
         """
         List all mail aliase for the account.
         """
-        request = self._xml_mail_packet(f"""\
-<get_info>
-    <filter>
-        <site-id>{self._site_id}</site-id>
-        <name>{account}</name>
-    </filter>
-    <aliases/>
-</get_info>\
-""")
+        request = _GET_INFO_TEMPLATE % (self.site_id, _xml_escape(account))
 
         resp = self._client.request(request)
-        response = lxml.etree.XML(resp)
-
-        if not self._verify_status_ok("./mail/get_info/result", response):
-            raise Exception(f"XML RPC response was not okay: '{resp}'")
 
+        # The list of aliases can be long, so stream the response instead of
+        # building the full tree
+        status = []
         aliases = []
-        for result in response.findall("./mail/get_info/result/mailname"):
-            for alias in result.findall("./alias"):
-                aliases.append(alias.text)
+        for _, el in _lazy_etree().iterparse(io.BytesIO(resp), events=("end",),
+                                             tag=("status", "alias"), **_PARSER_OPTIONS):
+            parent = el.getparent()
+            if "status" == el.tag and "result" == parent.tag:
+                status.append(el.text)
+            elif "alias" == el.tag and "mailname" == parent.tag:
+                aliases.append(el.text)
+
+            el.clear()
+            while el.getprevious() is not None:
+                del parent[0]
+
+        if ["ok"] != status:
+            if self._refresh_cached_site_id(resp):
+                return self.query_aliases(account)
+            raise Exception(f"XML RPC response was not okay: '{resp}'")
 
         return aliases
 
@@ -216,10 +425,10 @@ def parse_cmdline_args():
 
     p.add_argument("-L", dest="list", action="store_true", default=False,
                     help="List mail aliases")
-    p.add_argument("-A", dest="add",
-                    help="Add the new alias")
-    p.add_argument("-R", dest="remove",
-                    help="Remove the alias")
+    p.add_argument("-A", dest="add", action="append", default=[],
+                    help="Add the new alias (can be given multiple times)")
+    p.add_argument("-R", dest="remove", action="append", default=[],
+                    help="Remove the alias (can be given multiple times)")
 
     return p, p.parse_args()
 
@@ -228,7 +437,7 @@ def main():
 
     p, args = parse_cmdline_args()
 
-    if not args.list and args.add is None and args.remove is None:
+    if not args.list and not args.add and not args.remove:
         p.error("Either -L, -A or -R are requried")
 
     p = args.account.split("@")
@@ -242,17 +451,15 @@ def main():
 
     client = PleskApiClient(args.api_host)
     client.set_credentials(args.api_user, passwd)
-    mgr = PleskMailAliasManager(client, site)
+    atexit.register(client.close)
+    mgr = PleskMailAliasManager(client, site, SiteIdCache())
 
     if args.list:
         aliases = mgr.query_aliases(account)
-        print("aliases:")
-        for alias in aliases:
-            print(f"  - {alias}")
-    if args.add:
-        mgr.add_mail_alias(account, args.add)
-    if args.remove:
-        mgr.del_mail_alias(account, args.remove)
+        sys.stdout.write("aliases:\n" + "".join(f"  - {alias}\n" for alias in aliases))
+    if args.add or args.remove:
+        mgr.apply_changes([(account, alias) for alias in args.add],
+                          [(account, alias) for alias in args.remove])
 
 if "__main__" == __name__:
     main()